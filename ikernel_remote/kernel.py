@@ -7,12 +7,16 @@ job schedulers.
 """
 
 import secrets
-import random
+import selectors
 import argparse
+import base64
+import contextlib
+import getpass
 import json
 import logging
 import os
 import re
+import shlex
 import subprocess
 import sys
 import time
@@ -20,14 +24,25 @@ import uuid
 
 import pexpect
 
+try:
+    from orjson import dumps as _dumps
+except ImportError:
+    def _dumps(obj):
+        """Serialise obj to compact JSON bytes."""
+        return json.dumps(obj, separators=(',', ':')).encode()
+
 from tornado.log import LogFormatter
 
 from ikernel_remote import __version__
 
 # ALl the ports that need to be forwarded
-PORT_NAMES = [
+PORT_NAMES = (
     'hb_port', 'shell_port', 'iopub_port', 'stdin_port', 'control_port'
-]
+)
+# Command line argument for each port, e.g. --hb for hb_port
+_PORT_ARG_PAIRS = tuple((port[:-5], port) for port in PORT_NAMES)
+# Session arguments that are passed on as strings
+_SESSION_ARGS = ('signature_scheme', 'key', 'transport')
 
 # Blend in with the notebook logging
 _LOG_FMT = (
@@ -36,6 +51,61 @@ _LOG_FMT = (
 )
 _LOG_DATEFMT = "%H:%M:%S"
 
+# Socket used to multiplex the ssh sessions of one kernel to the same host
+# over a single connection. The prefix is unique to each kernel so that
+# closing one does not take down the masters of others, and %C (a hash of
+# the connection parameters) keeps the path within the socket name limit
+_SSH_CONTROL_PATH = '~/.ssh/ikr-{}-%C'
+
+# Prompts and messages that are matched when setting up connections,
+# compiled once rather than on every launch
+_RE_PASSPHRASE = re.compile(r'Enter passphrase .*:')
+_RE_PASSWORD = re.compile(r'[^@\s]+@\S+ password:')
+_RE_UUID = re.compile(
+    r"kernel-([0-9a-f]{8}-?[0-9a-f]{4}-?4[0-9a-f]{3}-"
+    r"?[89ab][0-9a-f]{3}-?[0-9a-f]{12})\.json"
+)
+_RE_PBS_READY = re.compile(r'qsub: job (.*) ready')
+_RE_PBS_NODE = re.compile(r'Running on ([\w.-]+)')
+_RE_SGE_NODE = re.compile(r'Establishing builtin session to host (.*) ...')
+_RE_SLURM_NODE = re.compile(r'srun: Node (.*), .* tasks started')
+
+# Passwords given by the user, keyed on the prompt
+_PASSWORD_CACHE = {}
+
+# Shell prompt set in ssh sessions to detect when commands have finished
+_PROMPT = 'IKR>>>>'
+_NO_MOUNT = 'IKR_NO_MOUNT'  # Echoed when sshfs fails to mount
+_LOGGED_IN = 'IKR_LOGGED_IN'  # Echoed by ssh sessions once logged in
+_TUNNEL_READY = 'Local connections to'  # Logged by ssh -v for each -L
+
+# Tunnels that die within this many seconds of starting are restarted
+# with an increasing delay, up to the maximum
+_TUNNEL_MIN_UPTIME = 10
+_TUNNEL_MAX_BACKOFF = 60
+
+# Interactive jobs for each scheduler as (display name, command,
+# message when the job is ready or None, command to print the node
+# name or None, message containing the node name)
+_SCHEDULERS = {
+    'pbs': (
+        'PBS/Torque', 'qsub -I {res} -N {name} {args}', _RE_PBS_READY,
+        # hostnames would be alphanumeric with . and - permitted
+        # This way we also ignore the echoed echo command
+        'echo Running on `hostname`', _RE_PBS_NODE
+    ),
+    'sge': (
+        'GridEngine', 'qlogin -now n {res} -N {name} {args}', None, None,
+        _RE_SGE_NODE
+    ),
+    'slurm': (
+        # -u disables buffering, -i is interactive, -v so we know the node
+        # tasks must be before the bash!
+        'SLURM', 'srun{res} -J {name} {args} -v -u bash -i', None, None,
+        _RE_SLURM_NODE
+    ),
+}
+
 
 def _setup_logging(verbose):
     """
@@ -78,14 +148,34 @@ def _setup_logging(verbose):
     return log
 
 
-def get_password(prompt):
+def _remove_file(filename):
+    """Remove a file, ignoring any errors."""
+    try:
+        os.remove(filename)
+    except Exception:
+        pass
+
+
+def _kill_process(proc):
+    """Kill a subprocess.Popen and wait for it to finish."""
+    proc.kill()
+    proc.wait()
+
+
+def get_password(prompt, cache=True):
     """
-    Interact with the user and ask for a password.
+    Interact with the user and ask for a password. Passwords are
+    remembered for each prompt so that the user is only asked once,
+    e.g. when several connections are made to the same host. Set
+    IKERNEL_REMOTE_NO_PASSWORD_CACHE in the environment to always ask.
 
     Parameters
     ----------
     prompt : str
         Text to show the user when asking for a password.
+    cache : bool
+        If False, always ask the user and forget any remembered password
+        for the prompt, e.g. because it was rejected.
 
     Returns
     -------
@@ -93,16 +183,31 @@ def get_password(prompt):
         The text input by the user.
 
     """
+    # 'user@host password:' and 'user@host password: ' are the same prompt
+    key = prompt.rstrip().rstrip(':')
+    if 'IKERNEL_REMOTE_NO_PASSWORD_CACHE' in os.environ:
+        cache = False
+    if not cache:
+        _PASSWORD_CACHE.pop(key, None)
+    elif key in _PASSWORD_CACHE:
+        return _PASSWORD_CACHE[key]
 
     if 'SSH_ASKPASS' in os.environ:
-        password = subprocess.check_output([os.environ['SSH_ASKPASS'], prompt])
+        # The helper prints the password followed by a newline
+        password = subprocess.check_output(
+            [os.environ['SSH_ASKPASS'], prompt]
+        ).decode().rstrip('\n')
+    elif sys.stdin.isatty():
+        password = getpass.getpass(prompt)
     else:
         raise RuntimeError("Unable to get password, try setting SSH_ASKPASS")
 
+    if cache:
+        _PASSWORD_CACHE[key] = password
     return password
 
 
-def check_password(connection):
+def check_password(connection, logged_in=None, timeout=2, login_timeout=60):
     """
     Check to see if a newly spawned process requires a password and retrieve
     it from the user if it does. Send the password to the process and
@@ -112,33 +217,52 @@ def check_password(connection):
     ----------
     connection : pexpect.spawn
         The connection to check. Requires an expect and sendline method.
+    logged_in : str, optional
+        Text that the process prints once it is logged in. If given, return
+        as soon as it appears instead of waiting for the timeout.
+    timeout : int
+        How long to wait for a prompt before assuming that no more
+        passwords are required, if logged_in is not given.
+    login_timeout : int
+        How long to wait for a prompt or logged_in, if it is given.
 
     """
+    patterns = [_RE_PASSPHRASE, _RE_PASSWORD, pexpect.EOF, pexpect.TIMEOUT]
+    if logged_in is not None:
+        # Nothing but a prompt or the marker can arrive first, so keep
+        # waiting for one of them; slow servers may take a while
+        patterns.append(re.escape(logged_in))
+        timeout = login_timeout
+    # Prompts already answered, if one comes back the password was wrong
+    answered = set()
     # This will loop until no more passwords are encountered
     while True:
-        try:
-            # Return all output as soon as anything arrives.
-            # Assume that immediate output includes the
-            # request for a password, or goes straight to
-            # a prompt.
-            text = connection.read_nonblocking(99999)
-        except pexpect.TIMEOUT:
-            # Nothing more to read from the output
-            return
-
-        re_passphrase = re.search('Enter passphrase .*:', text)
-        re_password = re.search('.*@.* password:', text)
-        if re_passphrase:
-            passphrase = get_password(re_passphrase.group())
-            connection.sendline(passphrase)
-        elif re_password:
-            password = get_password(re_password.group())
+        # Return as soon as a prompt appears. Without a marker, assume
+        # that if nothing turns up within the timeout the session went
+        # straight to a prompt.
+        index = connection.expect(patterns, timeout=timeout)
+        if index in (0, 1):
+            # Passphrase or password requested
+            prompt = connection.after
+            password = get_password(prompt, cache=prompt not in answered)
+            answered.add(prompt)
             connection.sendline(password)
         else:
             # No more passwords or passphrases requested
             return
 
 
+def _fenced_login(ssh_cmd):
+    """
+    Make an interactive ssh command echo _LOGGED_IN before starting the
+    login shell, so that check_password knows when authentication is done.
+    The marker is split so that a shell echoing the command doesn't match.
+    """
+    return "{} -t 'echo {}\"\"{}; exec \"$SHELL\" -l'".format(
+        ssh_cmd, _LOGGED_IN[:3], _LOGGED_IN[3:]
+    )
+
+
 def get_uuid(filename):
     """
     Given a filename containing a kernel, extract the uuid in
@@ -149,18 +273,15 @@ def get_uuid(filename):
         The name of the kernel-...-json file with the connection info.
     Returns
     -------
-    uuid : str or None
-        The extracted uuid, or None if not found.
+    uuid : str
+        The extracted uuid, or a new one if not found.
     """
     if filename is not None:
-        extracted = re.match(
-            ".*kernel-([0-9a-f]{8}-?[0-9a-f]{4}-?4[0-9a-f]{3}-"
-            "?[89ab][0-9a-f]{3}-?[0-9a-f]{12}).json",
-            filename,
-        )
+        # Only the file name needs to be searched, not the directory
+        extracted = _RE_UUID.fullmatch(os.path.basename(filename))
         if extracted is not None:
-            return uuid.UUID(extracted.group(1))
-    return uuid.uuid4()
+            return extracted.group(1)
+    return str(uuid.uuid4())
 
 
 def safe_eval(s):
@@ -207,7 +328,10 @@ class RemoteIKernel(object):
 
         """
 
-        self.sshfs_proc = None
+        # Cleanups to run when the kernel is closed, in reverse order
+        self._stack = contextlib.ExitStack()
+        self.sshfs_proc = None  # ssh session running sshfs on the host
+        self.sftp_proc = None  # local sftp-server feeding sshfs
         self.log = _setup_logging(verbose)
         self.log.info("Remote kernel version: {}.".format(__version__))
         self.log.info("File location: {}.".format(__file__))
@@ -226,10 +350,18 @@ class RemoteIKernel(object):
         self.workdir = workdir
         self.tunnel = tunnel
         self.tunnels = {}  # Processes running the SSH tunnels
+        self._tunnel_cmd_cached = None  # Tunnel command with ports filled in
+        self._tunnel_started = 0.0  # When the current tunnel was spawned
+        self._tunnel_backoff = 0.0  # Delay before restarting a dead tunnel
+        self._tunnel_retry_at = None  # When the dead tunnel is restarted
+        self._stack.callback(self._close_tunnels)
         self.precmd = precmd
         self.launch_args = launch_args
         self.cwd = os.getcwd()  # Launch directory may be needed if no workdir
         self.uuid = uuid
+        self._control_path = _SSH_CONTROL_PATH.format(secrets.token_hex(4))
+        self._known_hosts = set()  # Hosts found in ~/.ssh/known_hosts
+        self._stack.callback(self._exit_control_masters)
         # Directory where kernel files should be created on the host
         if runtimedir is None:
             runtimedir = '~/.local/share/jupyter/runtime'
@@ -238,27 +370,59 @@ class RemoteIKernel(object):
         if connection_file is not None:
             if os.path.exists(self.connection_file):
                 try:
-                    loaded_connection_info = json.load(open(connection_file))
-                    assert isinstance(connection_info, dict)
+                    with open(connection_file, 'rb') as cf:
+                        loaded_connection_info = json.loads(cf.read())
+                    assert isinstance(loaded_connection_info, dict)
                 except Exception:
                     loaded_connection_info = {}
             else:
                 loaded_connection_info = {}
                 self._delcf = True
+                self._stack.callback(_remove_file, connection_file)
             self.connection_info = loaded_connection_info.copy()
             self.connection_info.update(connection_info)
             if self._delcf or self.connection_info != loaded_connection_info:
+                # Write to a temporary file first so that the notebook
+                # never sees a partially written file. The file holds the
+                # HMAC key, so it is only readable by the user, as Jupyter
+                # creates it.
+                tmp_file = connection_file + '.tmp'
                 try:
-                    json.dump(
-                        self.connection_info,
-                        open(connection_file, 'w'),
-                        indent=2
+                    fd = os.open(
+                        tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
                     )
+                    with open(fd, 'wb') as cf:
+                        cf.write(_dumps(self.connection_info))
+                    os.replace(tmp_file, connection_file)
                 except Exception:
-                    pass
+                    _remove_file(tmp_file)
         else:
             self.connection_info = connection_info
 
+        try:
+            self._launch()
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Make final cleanups: stop the tunnels and any sshfs mount and
+        remove a connection file that was created here.
+        """
+        self._stack.close()
+
+    def _launch(self):
+        """
+        Start the session through the interface, then the kernel
+        and the tunnels to it.
+        """
         # Initiate an ssh tunnel through any tunnel hosts
         # this will start a pexpect, so we must check if
         # self.connection exists when launching the interface
@@ -267,16 +431,12 @@ class RemoteIKernel(object):
 
         if self.interface == 'local':
             self.launch_local()
-        elif self.interface == 'pbs':
-            self.launch_pbs()
-        elif self.interface == 'sge':
-            self.launch_sge()
         elif self.interface == 'ssh':
             self.launch_ssh()
-        elif self.interface == 'slurm':
-            self.launch_slurm()
+        elif self.interface in _SCHEDULERS:
+            self._launch_scheduler(self.interface)
         else:
-            raise ValueError("Unknown interface {}".format(interface))
+            raise ValueError("Unknown interface {}".format(self.interface))
 
         # If we've established a connection, start the kernel!
         if self.connection is not None:
@@ -284,16 +444,6 @@ class RemoteIKernel(object):
             if self.tunnel:
                 self.tunnel_connection()
 
-    def __del__(self):
-        """
-        Make final cleanups.
-        """
-        if self._delcf:
-            try:
-                os.remove(self.connection_file)
-            except Exception:
-                pass
-
     def launch_tunnel_hosts(self):
         """
         Build a chain of hosts to tunnel through and start an ssh
@@ -301,8 +451,8 @@ class RemoteIKernel(object):
         """
         tunnel_hosts_cmd = self.tunnel_hosts_cmd
         self.log.debug("Tunnel proxy command: {}.".format(tunnel_hosts_cmd))
-        self._spawn(tunnel_hosts_cmd)
-        check_password(self.connection)
+        self._spawn(_fenced_login(tunnel_hosts_cmd))
+        check_password(self.connection, logged_in=_LOGGED_IN)
 
     def launch_local(self):
         """
@@ -324,146 +474,161 @@ class RemoteIKernel(object):
 
         Launch an ssh connection using pexpect so it can be interacted with.
         """
-        pr = 34000 + random.randint(0, 999) # ha
-        pl = 35000 + random.randint(0, 999)
         wd = f'/tmp/ikrsshfs-{secrets.token_urlsafe()}'
-        self.sshfs_proc = subprocess.Popen([
-            'ncat', '-l', '-p', str(pl), '-e',
-            f'/usr/lib/openssh/sftp-server -d {self.cwd}'
-            ])
-        time.sleep(0.1)
-        assert self.sshfs_proc.returncode is None
         self.log.info("Launching kernel over SSH.")
         if self.launch_args:
             launch_args = self.launch_args
         else:
             launch_args = ''
-        login_cmd = 'ssh -R {port_remote}:localhost:{port_local} -o StrictHostKeyChecking=no {args} {host}'.format(
-            args=launch_args, host=self.host,
-            port_remote=pr,
-            port_local=pl
+        login_cmd = '{ssh} {args} {host}'.format(
+            ssh=self._ssh_base(), args=launch_args, host=self.host
         )
         self.log.debug("Login command: '{}'.".format(login_cmd))
-        ssh = self._spawn(login_cmd)
-        check_password(self.connection)
-        ssh.sendline(f'mkdir -p {wd}')
-        ssh.sendline(f'sshfs localhost: {wd} -o directport={pr}')
-        ssh.sendline(f'cd {wd}')
-
-    def __del__(self):
-        if self.sshfs_proc is not None:
-            self.sshfs_proc.kill()
-            self.sshfs_proc.wait()
-            self.sshfs_proc = None
+        ssh = self._spawn(_fenced_login(login_cmd))
+        check_password(self.connection, logged_in=_LOGGED_IN)
+        # Use a fixed prompt so that we can tell when each command has
+        # finished. It is split in the command so the echo doesn't match.
+        ssh.sendline(
+            "export PS1='{}''{}'; unset PROMPT_COMMAND".format(
+                _PROMPT[:3], _PROMPT[3:]
+            )
+        )
+        ssh.expect_exact(_PROMPT)
+        self.mount_sshfs(wd, launch_args)
+        # The mount is made by a separate session, so wait for it to
+        # appear before moving into it. The marker is split like the
+        # prompt so that the echoed command doesn't match.
+        ssh.sendline(
+            f'for i in $(seq 100); do mountpoint -q {wd} && break; '
+            f'sleep 0.1; done; mountpoint -q {wd} && cd {wd} || '
+            f"echo '{_NO_MOUNT[:3]}''{_NO_MOUNT[3:]}'"
+        )
+        mounted = ssh.expect_exact([_PROMPT, _NO_MOUNT]) == 0
+        if not mounted:
+            # The kernel is still usable without the local files, so
+            # carry on from the login directory
+            ssh.expect_exact(_PROMPT)
+            status = self.sshfs_proc.poll()
+            if status is not None:
+                reason = "sshfs session exited with status {}".format(status)
+            else:
+                reason = "timed out waiting for the mount"
+            self.log.error(
+                "Unable to mount working directory on {}: {}.".format(
+                    self.host, reason
+                )
+            )
 
-    def launch_pbs(self):
+    def mount_sshfs(self, wd, launch_args=''):
         """
-        Start a kernel through the torque 'qsub -I' command. The connection
-        will use the object's connection_info and kernel_command.
+        Mount the local working directory on the remote host at `wd`.
+
+        A local sftp-server is connected directly to the stdin and stdout
+        of an ssh session running sshfs in slave mode, so the filesystem
+        traffic goes over the ssh channel without any extra listener or
+        port forward. When the host is reached directly, the ssh session
+        reuses the master connection of the login session, so no further
+        authentication is needed. Through tunnel hosts the login session
+        runs on the last of them, so the mount connects through the same
+        chain of hosts itself.
         """
-        self.log.info("Launching kernel through PBS/Torque.")
-        job_name = 'ikernel_remote'
-        res = []
-        if self.cpus > 1:
-            res.append('ncpus={cpus}'.format(cpus=self.cpus))
-        if self.mem is not None:
-            res.append('mem={mem}'.format(mem=self.mem))
-        if self.time is not None:
-            res.append('walltime={time}'.format(time=self.time))
-        if res:
-            res_string = '-l ' + ','.join(res)
-        else:
-            res_string = ''
-        if self.launch_args:
-            args_string = self.launch_args
+        # Cross connect the two processes
+        sftp_in, ssh_out = os.pipe()
+        ssh_in, sftp_out = os.pipe()
+        if self.tunnel_hosts:
+            jumps = '-J ' + ','.join(self.tunnel_hosts)
         else:
-            args_string = ''
-        pbs_cmd = 'qsub -I {} -N {} {}'.format(
-            res_string, job_name, args_string
+            jumps = ''
+        mount_cmd = (
+            '{ssh} {jumps} {args} {host} mkdir -p {wd} && '
+            'sshfs localhost: {wd} -o slave'.format(
+                ssh=self._ssh_base(), jumps=jumps, args=launch_args,
+                host=self.host, wd=wd
+            )
         )
-        self.log.debug("PBS command: '{}'.".format(pbs_cmd))
-        # Will wait in the queue for up to 10 mins
-        qsub_i = self._spawn(pbs_cmd)
-        # Hopefully this text is universal? Job started...
-        qsub_i.expect('qsub: job (.*) ready')
-        # Now we have to ask for the hostname (any way for it to
-        # say automatically?)
-        qsub_i.sendline('echo Running on `hostname`')
-
-        # hostnames would be alphanumeric with . and - permitted
-        # This way we also ignore the echoed echo command
-        qsub_i.expect('Running on ([\w.-]+)')
-        node = qsub_i.match.groups()[0]
-
-        self.log.info("Established session on node: {}.".format(node))
-        self.host = node
-
-    def launch_sge(self):
+        self.log.debug("Mount command: '{}'.".format(mount_cmd))
+        try:
+            self.sftp_proc = subprocess.Popen(
+                ['/usr/lib/openssh/sftp-server', '-d', self.cwd],
+                stdin=sftp_in, stdout=sftp_out
+            )
+            self._stack.callback(_kill_process, self.sftp_proc)
+            self.sshfs_proc = subprocess.Popen(
+                shlex.split(mount_cmd), stdin=ssh_in, stdout=ssh_out
+            )
+            self._stack.callback(_kill_process, self.sshfs_proc)
+        finally:
+            for fd in (sftp_in, ssh_out, ssh_in, sftp_out):
+                os.close(fd)
+        if self.sftp_proc.poll() is not None:
+            raise RuntimeError("Unable to start sftp-server")
+
+    def _scheduler_resources(self, scheduler):
         """
-        Start a kernel through the gridengine 'qlogin' command. The connection
-        will use the object's connection_info and kernel_command.
+        Build the part of the scheduler command that requests cpus, memory
+        and time for the job.
         """
-        self.log.info("Launching kernel through GridEngine.")
-        job_name = 'ikernel_remote'
-        if self.cpus > 1:
-            pe_string = "-pe {pe} {cpus}".format(pe=self.pe, cpus=self.cpus)
-        else:
-            pe_string = ''
+        if scheduler == 'slurm':
+            opts = ''
+            if self.cpus > 1:
+                opts += ' --cpus-per-task {cpus}'.format(cpus=self.cpus)
+            if self.mem is not None:
+                opts += ' --mem {mem}'.format(mem=self.mem)
+            if self.time is not None:
+                opts += ' --time {time}'.format(time=self.time)
+            return opts
+
         res = []
-        if self.mem is not None:
-            res.append('h_vmem={mem}'.format(mem=self.mem))
-        if self.time is not None:
-            res.append('h_rt={time}'.format(time=self.time))
+        if scheduler == 'pbs':
+            if self.cpus > 1:
+                res.append('ncpus={cpus}'.format(cpus=self.cpus))
+            if self.mem is not None:
+                res.append('mem={mem}'.format(mem=self.mem))
+            if self.time is not None:
+                res.append('walltime={time}'.format(time=self.time))
+        else:
+            if self.mem is not None:
+                res.append('h_vmem={mem}'.format(mem=self.mem))
+            if self.time is not None:
+                res.append('h_rt={time}'.format(time=self.time))
         if res:
             res_string = '-l ' + ','.join(res)
         else:
             res_string = ''
-        if self.launch_args:
-            args_string = self.launch_args
-        else:
-            args_string = ''
-        sge_cmd = 'qlogin -now n {pe} {res} -N {name} {args}'.format(
-            pe=pe_string, res=res_string, name=job_name, args=args_string
-        )
-        self.log.debug("Gridengine command: '{}'.".format(sge_cmd))
-        # Will wait in the queue for up to 10 mins
-        qlogin = self._spawn(sge_cmd)
-        # Hopefully this text is universal?
-        qlogin.expect('Establishing builtin session to host (.*) ...')
-
-        node = qlogin.match.groups()[0]
-        self.log.info("Established session on node: {}.".format(node))
-        self.host = node
+        if scheduler == 'sge' and self.cpus > 1:
+            pe_string = "-pe {pe} {cpus}".format(pe=self.pe, cpus=self.cpus)
+            res_string = '{} {}'.format(pe_string, res_string)
+        return res_string
 
-    def launch_slurm(self):
+    def _launch_scheduler(self, scheduler):
         """
-        Start a kernel through the slurm 'srun' command. Bind the spawned
-        pexpect to the class to interact with it.
+        Start a kernel through an interactive job of one of the
+        schedulers in _SCHEDULERS. The connection will use the
+        object's connection_info and kernel_command.
         """
-        self.log.info("Launching kernel through SLURM.")
-        job_name = 'ikernel_remote'
-        opts = ''
-        if self.cpus > 1:
-            opts += ' --cpus-per-task {cpus}'.format(cpus=self.cpus)
-        if self.mem is not None:
-            opts += ' --mem {mem}'.format(mem=self.mem)
-        if self.time is not None:
-            opts += ' --time {time}'.format(time=self.time)
+        name, command, ready, echo_node, node_regex = _SCHEDULERS[scheduler]
+        self.log.info("Launching kernel through {}.".format(name))
         if self.launch_args:
-            launch_args = self.launch_args
+            args_string = self.launch_args
         else:
-            launch_args = ''
-        # -u disables buffering, -i is interactive, -v so we know the node
-        # tasks must be before the bash!
-        srun_cmd = 'srun{opts} -J {job_name} {args} -v -u bash -i'.format(
-            opts=opts, job_name=job_name, args=launch_args
+            args_string = ''
+        job_cmd = command.format(
+            res=self._scheduler_resources(scheduler), name='ikernel_remote',
+            args=args_string
         )
-        self.log.info("SLURM command: '{}'.".format(srun_cmd))
-        srun = self._spawn(srun_cmd)
+        self.log.debug("{} command: '{}'.".format(name, job_cmd))
+        # Will wait in the queue for up to 10 mins
+        job = self._spawn(job_cmd)
+        if ready is not None:
+            # Job started...
+            job.expect(ready)
+        if echo_node is not None:
+            # Ask for the hostname if the scheduler does not say it
+            job.sendline(echo_node)
         # Hopefully this text is universal?
-        srun.expect('srun: Node (.*), .* tasks started')
+        job.expect(node_regex)
 
-        node = srun.match.groups()[0]
+        node = job.match.groups()[0]
         self.log.info("Established session on node: {}.".format(node))
         self.host = node
 
@@ -474,14 +639,18 @@ class RemoteIKernel(object):
         conn = self.connection
         self.log.info("Established connection; starting kernel.")
 
+        # All the commands are sent to the remote shell in one go, rather
+        # than a line at a time, so setup only costs a single round trip.
+        script = []
+
         # Use the specified working directory or try to change to the same
         # directory on the remote machine.
         if self.workdir:
             self.log.info("Remote working directory {}.".format(self.workdir))
-            conn.sendline('cd {}'.format(self.workdir))
+            script.append('cd {}'.format(self.workdir))
         else:
             self.log.info("Current working directory {}.".format(self.cwd))
-            conn.sendline('cd {}'.format(self.cwd))
+            script.append('cd {}'.format(self.cwd))
 
         if '{host_connection_file}' in self.kernel_cmd:
             kernel_name = "kernel-remote-{}.json".format(self.uuid)
@@ -491,36 +660,39 @@ class RemoteIKernel(object):
             host_connection_file = None
 
         # Create a temporary file to store a copy of the connection information
-        # Delete the file if it already exists
+        # Overwrite the file if it already exists
         if host_connection_file is not None:
             connection_file_dir = os.path.dirname(host_connection_file)
-            conn.sendline('mkdir -p {}'.format(connection_file_dir))
-            conn.sendline('rm -f {}'.format(host_connection_file))
-            file_contents = json.dumps(self.connection_info)
-            conn.sendline(
-                'echo \'{}\' > {}'.format(file_contents, host_connection_file)
+            script.append('mkdir -p {}'.format(connection_file_dir))
+            # base64 can't contain anything the shell would interpret
+            file_contents = base64.b64encode(_dumps(self.connection_info))
+            script.append(
+                'printf %s {} | base64 -d > {}'.format(
+                    file_contents.decode(), host_connection_file
+                )
             )
 
         # Is this the best place for a pre-command? I guess people will just
         # have to deal with it. Pass it on as is.
         if self.precmd:
-            conn.sendline(self.precmd)
+            script.append(self.precmd)
 
         # Init as a background process so we can delete the tempfile after
         kernel_init = self.kernel_cmd.format(
             host_connection_file=host_connection_file, **self.connection_info
         )
         self.log.info("Running kernel command: '{}'.".format(kernel_init))
-        conn.sendline(kernel_init)
+        script.append(kernel_init)
 
         if host_connection_file is not None:
             # The kernel blocks further commands, so queue deletion of the
             # transient file for once the process stops. Trying to do this
             # whilst simultaneously starting the kernel ended up deleting
             # the file before it was read.
-            conn.sendline('rm -f {}'.format(host_connection_file))
+            script.append('rm -f {}'.format(host_connection_file))
 
-        conn.sendline('exit')
+        script.append('exit')
+        conn.sendline('\n'.join(script))
         # Could check this for errors?
         conn.expect('exit')
 
@@ -532,17 +704,34 @@ class RemoteIKernel(object):
         # This might need to change, but the other option is to get user or
         # admin to turn StrictHostKeyChecking off in .ssh/ssh_config for this
         # to work seamlessly. (tunnels will have already done this)
-        pre = self.tunnel_hosts_cmd or ''
-        pexpect.spawn(
-            '{pre} ssh -o StrictHostKeyChecking=no '
-            '{host}'.format(pre=pre, host=self.host).strip(),
-            encoding='utf-8'
-        ).sendline('exit')
-
-        # connection info should have the ports being used
-        tunnel_command = self.tunnel_cmd.format(**self.connection_info)
+        # The key is accepted by a connection like the tunnel's, made from
+        # here, that only runs 'true'. This is not needed if the host is
+        # already known or a master connection to it is running, e.g. when
+        # restarting a tunnel.
+        if self._needs_hostkey_priming(self.host):
+            ssh, host = self._own_ssh()
+            primer = pexpect.spawn(
+                '{} {} true'.format(ssh, host), encoding='utf-8'
+            )
+            # Returns once the command has finished
+            check_password(primer, timeout=60)
+            primer.close(force=True)
+
+        # connection info should have the ports being used, these don't
+        # change so the command is only built once and reused on restarts
+        if self._tunnel_cmd_cached is None:
+            self._tunnel_cmd_cached = self.tunnel_cmd.format(
+                **self.connection_info
+            )
+        tunnel_command = self._tunnel_cmd_cached
+        # Release the pty of a previous tunnel before replacing it
+        self._close_tunnels()
         tunnel = pexpect.spawn(tunnel_command, encoding='utf-8')
-        check_password(tunnel)
+        self.tunnels['tunnel'] = tunnel
+        # The tunnel prints nothing of its own, so wait for ssh to report
+        # the forwards, which only happens once it has logged in
+        check_password(tunnel, logged_in=_TUNNEL_READY)
+        self._tunnel_started = time.monotonic()
 
         self.log.info(
             "Setting up tunnels on ports: {}.".format(
@@ -554,55 +743,111 @@ class RemoteIKernel(object):
         )
         self.log.debug("Tunnel command: {}.".format(tunnel_command))
 
-        # Store the tunnel
-        self.tunnels['tunnel'] = tunnel
+    def _close_tunnels(self):
+        """
+        Close the tunnel processes and forget about them.
+        """
+        while self.tunnels:
+            _, tunnel = self.tunnels.popitem()
+            tunnel.close(force=True)
 
     def check_tunnels(self):
         """
-        Check the PID of tunnels and restart any that have died.
+        Check the PID of tunnels and restart any that have died. A tunnel
+        that dies shortly after starting (e.g. because a local port is
+        taken) is restarted after a delay that doubles every time.
         """
-        if not self.tunnels['tunnel'].isalive():
-            self.log.debug("Restarting ssh tunnels.")
-            self.tunnel_connection()
+        tunnel = self.tunnels.get('tunnel')
+        if tunnel is None or tunnel.isalive():
+            return
+        now = time.monotonic()
+        if self._tunnel_retry_at is None:
+            if now - self._tunnel_started < _TUNNEL_MIN_UPTIME:
+                self._tunnel_backoff = min(
+                    max(2 * self._tunnel_backoff, 1), _TUNNEL_MAX_BACKOFF
+                )
+            else:
+                self._tunnel_backoff = 0.0
+            self._tunnel_retry_at = now + self._tunnel_backoff
+            if self._tunnel_backoff:
+                self.log.debug(
+                    "Tunnel died, restarting in {:g}s.".format(
+                        self._tunnel_backoff
+                    )
+                )
+        if now < self._tunnel_retry_at:
+            return
+        self._tunnel_retry_at = None
+        self.log.debug("Restarting ssh tunnels.")
+        self.tunnel_connection()
 
     def keep_alive(self, timeout=5):
         """
         Keep the script alive forever. KeyboardInterrupt will get passed on
-        to the kernel. The timeout determines how often the ssh tunnels are
-        checked.
-        """
-        # The timeout determines how long each loop will be,
-        # if an ssh tunnel dies, this is how long it will be
-        # before it is revived.
-        self.connection.timeout = timeout
-        time.sleep(timeout)
-
-        # There might be a more elegant way to do this, but since this
-        # process doesn't do anything and is managed by the notebook
-        # it really doesn't matter
+        to the kernel. The script sleeps until there is output from the
+        kernel or the tunnels; the timeout determines how often the ssh
+        tunnels are checked when nothing happens.
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(
+            self.connection.child_fd, selectors.EVENT_READ, self.connection
+        )
+        watched_tunnel = self._watch_tunnel(selector, None)
+
         while True:
+            kernel_eof = False
+            try:
+                events = selector.select(timeout)
+            except KeyboardInterrupt:
+                self.log.info("Caught interrupt; sending to kernel.")
+                self.connection.sendcontrol('c')
+                continue
+            for key, _ in events:
+                try:
+                    # read anything from the output in one chunk,
+                    # pexpect logging will be set up to emit anything if
+                    # required. The output must be drained or the process
+                    # will block once the pty buffer fills.
+                    key.data.read_nonblocking(65536, 0)
+                except pexpect.TIMEOUT:
+                    pass
+                except pexpect.EOF:
+                    # A closed pty is always readable, stop watching it
+                    selector.unregister(key.fd)
+                    if key.data is self.connection:
+                        kernel_eof = True
+
             # If the kernel dies, we should too, but try and
             # give some error info
-            if not self.connection.isalive():
+            if kernel_eof or not self.connection.isalive():
                 self.log.error("Kernel died.")
-                for line in self.connection.readlines():
-                    if line.strip():
-                        self.log.error(line)
+                data = self.connection.read()
+                if data.strip():
+                    self.log.error(data)
                 break
             # Kernel is still alive, ensure tunnels are too
             self.check_tunnels()
-            try:
-                # read anything from the kernel output, pexpect
-                # logging will be set up to emit anything if
-                # required.
-                self.connection.readlines()
-            except pexpect.TIMEOUT:
-                # Raises timeout if there is no data, prevents blocking
-                # Moves on to the next loop.
-                pass
-            except KeyboardInterrupt:
-                self.log.info("Caught interrupt; sending to kernel.")
-                self.connection.sendcontrol('c')
+            watched_tunnel = self._watch_tunnel(selector, watched_tunnel)
+
+        selector.close()
+
+    def _watch_tunnel(self, selector, watched):
+        """
+        Make the selector watch the current tunnel instead of the
+        previously watched one, which may have been restarted. Return
+        the tunnel that is now being watched.
+        """
+        tunnel = self.tunnels.get('tunnel')
+        if tunnel is watched:
+            return watched
+        # The old tunnel may already be closed, so find it by object
+        # rather than by its child_fd
+        for key in list(selector.get_map().values()):
+            if watched is not None and key.data is watched:
+                selector.unregister(key.fd)
+        if tunnel is not None:
+            selector.register(tunnel.child_fd, selectors.EVENT_READ, tunnel)
+        return tunnel
 
     def _spawn(self, command, timeout=600):
         """
@@ -632,6 +877,86 @@ class RemoteIKernel(object):
 
         return self.connection
 
+    def _ssh_base(self):
+        """
+        Return the base ssh command. Connections to the same host share
+        a persistent master connection so that only the first one has to
+        go through the full handshake and authentication.
+        """
+        return (
+            'ssh -o StrictHostKeyChecking=no -o ControlMaster=auto '
+            '-o ControlPath={} -o ControlPersist=600'
+        ).format(self._control_path)
+
+    def _exit_control_masters(self):
+        """
+        Ask the master connections that this kernel started for the remote
+        host and the last tunnel host to exit.
+        """
+        hosts = [self.host]
+        if self.tunnel_hosts:
+            hosts.append(self.tunnel_hosts[-1])
+        for host in hosts:
+            if host:
+                self._control_master(host, 'exit')
+
+    def _control_master(self, host, command):
+        """
+        Send a control command ('check', 'exit') to the master connection
+        for host. Return True if the command succeeded.
+        """
+        cmd = ['ssh', '-o', 'ControlPath={}'.format(self._control_path)]
+        if ':' in host:
+            host, port = host.split(":")
+            cmd.extend(['-p', port])
+        cmd.extend(['-O', command, host])
+        try:
+            return subprocess.call(
+                cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            ) == 0
+        except Exception:
+            return False
+
+    def _own_ssh(self):
+        """
+        Return the ssh command and host name for a connection from here
+        to the host that goes through the tunnel hosts and doesn't share
+        a master connection. -S none stops a ControlPath in the user's
+        ssh_config from being used.
+        """
+        ssh = 'ssh -o StrictHostKeyChecking=no -S none'
+        # Add all the gateway machines as an ssh chain
+        if self.tunnel_hosts:
+            ssh += ' -J ' + ','.join(self.tunnel_hosts)
+        host = self.host
+        if ':' in host:
+            host, host_port = host.split(":")
+            ssh += ' -p ' + host_port
+        return ssh, host
+
+    def _needs_hostkey_priming(self, host):
+        """
+        Return False if the key of host is already in known_hosts, or
+        a master connection to it is running. Known hosts are cached.
+        """
+        if host in self._known_hosts:
+            return False
+        if ':' in host:
+            lookup = '[{}]:{}'.format(*host.split(":"))
+        else:
+            lookup = host
+        try:
+            known = subprocess.call(
+                ['ssh-keygen', '-F', lookup],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            ) == 0
+        except Exception:
+            known = False
+        if known:
+            self._known_hosts.add(host)
+            return False
+        return not self._control_master(host, 'check')
+
     @property
     def tunnel_hosts_cmd(self):
         """Return the ssh command to tunnel through the middle hosts."""
@@ -646,11 +971,9 @@ class RemoteIKernel(object):
 
         if ':' in host:
             host, port = host.split(":")
-            ssh = 'ssh -o StrictHostKeyChecking=no {} -p {} {}'.format(
-                jumps, port, host
-            )
+            ssh = '{} {} -p {} {}'.format(self._ssh_base(), jumps, port, host)
         else:
-            ssh = 'ssh -o StrictHostKeyChecking=no {} {}'.format(jumps, host)
+            ssh = '{} {} {}'.format(self._ssh_base(), jumps, host)
 
         return ssh
 
@@ -659,31 +982,24 @@ class RemoteIKernel(object):
         """Return a tunnelling command that just needs a port."""
 
         # One connection can tunnel all the ports
-        ports_str = " ".join([
-            "-L 127.0.0.1:{{{port}}}:127.0.0.1:{{{port}}}"
-            "".format(port=port) for port in PORT_NAMES
-        ])
-
-        # Add all the gateway machines as an ssh chain
-        if self.tunnel_hosts:
-            jumps = '-J ' + ','.join(host for host in self.tunnel_hosts)
-        else:
-            jumps = ''
+        ports_str = " ".join(
+            f"-L 127.0.0.1:{{{port}}}:127.0.0.1:{{{port}}}"
+            for port in PORT_NAMES
+        )
 
-        if ':' in self.host:
-            host, host_port = self.host.split(":")
-            ssh = 'ssh -o StrictHostKeyChecking=no -p {host_port}'.format(
-                host_port=host_port
-            )
-        else:
-            ssh = 'ssh -o StrictHostKeyChecking=no'
-            host = self.host
+        # The tunnel has its own connection rather than sharing a master,
+        # so that the keepalives and the process state belong to it
+        ssh, host = self._own_ssh()
 
-        # Timeout is specified here, this should be longer than the checking
-        # interval
+        # Fail if any port can't be forwarded (e.g. it is already in use),
+        # so the tunnel is restarted rather than left half working.
+        # The tunnel runs no remote command and stays up until keepalives
+        # stop being answered. -v makes it report _TUNNEL_READY.
         tunnel_cmd = (
-            "{ssh} {jumps} -S none {ports_str} {host} sleep 600".format(
-                ssh=ssh, jumps=jumps, host=host, ports_str=ports_str
+            "{ssh} -v -N -o ExitOnForwardFailure=yes "
+            "-o ServerAliveInterval=30 -o ServerAliveCountMax=3 "
+            "{ports_str} {host}".format(
+                ssh=ssh, host=host, ports_str=ports_str
             )
         )
 
@@ -691,11 +1007,10 @@ class RemoteIKernel(object):
         return tunnel_cmd
 
 
-def start_remote_kernel():
+def _build_parser():
     """
-    Read command line arguments and initialise a kernel.
+    Build the parser for the kernel launcher command line.
     """
-
     # These will not face a user since they are interpreting the command from
     # kernel the kernel.json
     description = "This is the kernel launcher, did you mean '%prog manage'"
@@ -719,28 +1034,33 @@ def start_remote_kernel():
     parser.add_argument('--tunnel-hosts', nargs='+')
     parser.add_argument('--runtimedir')
 
-    for port in PORT_NAMES:
-        parser.add_argument('--{}'.format(port[:-5]), type=int, default=0)
+    for arg, _ in _PORT_ARG_PAIRS:
+        parser.add_argument('--{}'.format(arg), type=int, default=0)
     parser.add_argument('--ip')
     parser.add_argument('--signature_scheme', '--Session.signature_scheme')
     parser.add_argument('--key', '--Session.key')
     parser.add_argument('--transport')
 
-    args = parser.parse_args()
+    return parser
+
+
+def start_remote_kernel():
+    """
+    Read command line arguments and initialise a kernel.
+    """
+    args = _build_parser().parse_args()
 
     connection_info = {}
-    for port in PORT_NAMES:
-        arg = getattr(args, port[:-5])
-        if args.hb:
-            connection_info[port] = arg
+    for arg, port in _PORT_ARG_PAIRS:
+        value = getattr(args, arg)
+        if value:
+            connection_info[port] = value
     if args.ip:
         connection_info['ip'] = args.ip
-    if args.signature_scheme:
-        connection_info['signature_scheme'] = safe_eval(args.signature_scheme)
-    if args.key:
-        connection_info['key'] = safe_eval(args.key)
-    if args.transport:
-        connection_info['transport'] = safe_eval(args.transport)
+    for arg in _SESSION_ARGS:
+        value = getattr(args, arg)
+        if value:
+            connection_info[arg] = safe_eval(value)
 
     kernel = RemoteIKernel(
         connection_file=args.f,
@@ -760,4 +1080,7 @@ def start_remote_kernel():
         runtimedir=args.runtimedir,
         uuid=get_uuid(args.f)
     )
-    kernel.keep_alive()
+    try:
+        kernel.keep_alive()
+    finally:
+        kernel.close()
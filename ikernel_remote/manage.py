@@ -8,14 +8,11 @@ Run ``ikernel_remote manage`` to see a list of commands.
 
 from __future__ import print_function
 
-import argparse
-import getpass
 import json
 import os
 import re
 import sys
 from os import path
-from subprocess import list2cmdline
 
 # How we identify kernels that ikernel_remote will manage
 # These go through a compatibility layer to work with IPython and Jupyter
@@ -24,6 +21,150 @@ from ikernel_remote.compat import tempdir
 
 from ikernel_remote import __version__
 
+# Faster JSON if it is available
+try:
+    import orjson
+
+    def _dumps(obj):
+        """Serialise obj to indented JSON bytes with sorted keys."""
+        return orjson.dumps(
+            obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+        )
+
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        """Serialise obj to indented JSON bytes with sorted keys."""
+        return json.dumps(obj, sort_keys=True, indent=2).encode()
+
+    _loads = json.loads
+
+# Characters that can't be used in kernel names
+_NONWORD = re.compile(r'\W')
+
+# Kernel names that Jupyter accepts, see jupyter_client.kernelspec
+_VALID_KERNEL_NAME = re.compile(r'^[a-z0-9._\-]+$', re.IGNORECASE)
+
+# Part of the kernel name (None for no part) and display name
+# for each interface
+_INTERFACES = {
+    'local': ('local', "Local"),
+    'pbs': (None, "PBS"),
+    'sge': ('sge', "GridEngine"),
+    'ssh': ('ssh', "SSH"),
+    'slurm': ('slurm', "SLURM"),
+}
+
+# Python used to run the kernel launcher
+_PY_EXE = sys.executable
+
+
+def _cmdline(args):
+    """Join a command, quoted for the shell it will be run from."""
+    if os.name != 'nt':
+        try:
+            from shlex import join
+            return join(args)
+        except ImportError:
+            # Python < 3.8
+            pass
+    from subprocess import list2cmdline
+    return list2cmdline(args)
+
+
+class _SpecCache(object):
+    """
+    Index of the installed kernel specs that is kept on disk, so that
+    each kernel.json only has to be parsed again when it changes.
+
+    Maps kernel_name to the resource_dir, mtime of kernel.json,
+    display_name and whether the kernel is managed by ikernel_remote.
+    """
+
+    version = 1
+
+    def __init__(self, filename=None):
+        if filename is None:
+            cache_dir = os.environ.get('XDG_CACHE_HOME') or path.join(
+                path.expanduser('~'), '.cache'
+            )
+            filename = path.join(cache_dir, 'ikernel_remote', 'index.json')
+        self.filename = filename
+        self.kernels = {}
+        self.dirty = False
+
+    def load(self):
+        """Read the index, starting empty if it is missing or outdated."""
+        try:
+            with open(self.filename) as cache_file:
+                data = json.load(cache_file)
+            if data['version'] == self.version:
+                self.kernels = data['kernels']
+        except (OSError, ValueError, KeyError, TypeError):
+            self.kernels = {}
+
+    def save(self):
+        """Write the index back if anything changed."""
+        if not self.dirty:
+            return
+        try:
+            os.makedirs(path.dirname(self.filename), exist_ok=True)
+            with open(self.filename, 'w') as cache_file:
+                json.dump(
+                    {'version': self.version, 'kernels': self.kernels},
+                    cache_file
+                )
+            self.dirty = False
+        except OSError:
+            # Not being able to cache is not an error
+            pass
+
+    def lookup(self, kernel_name, resource_dir):
+        """
+        Return the display_name of the kernel and whether it is managed
+        by ikernel_remote. The kernel.json is only read if it has changed
+        since it was cached.
+        """
+        mtime = os.stat(path.join(resource_dir, 'kernel.json')).st_mtime
+        entry = self.kernels.get(kernel_name)
+        if (
+            entry is not None and entry['resource_dir'] == resource_dir and
+            entry['mtime'] == mtime
+        ):
+            return entry['display_name'], entry['is_remote']
+
+        # The directory is already known, so read the file directly
+        # rather than searching for the spec again
+        with open(path.join(resource_dir, 'kernel.json'), 'rb') as kernel_file:
+            kernel_json = _loads(kernel_file.read())
+        display_name = kernel_json.get('display_name', kernel_name)
+        is_remote = 'ikernel_remote' in kernel_json.get('argv', [])
+        self.kernels[kernel_name] = {
+            'resource_dir': resource_dir,
+            'mtime': mtime,
+            'display_name': display_name,
+            'is_remote': is_remote
+        }
+        self.dirty = True
+        return display_name, is_remote
+
+    def is_remote(self, kernel_name, resource_dir):
+        """
+        Return True if the kernel is managed by ikernel_remote. Kernels
+        without a valid kernel.json are not.
+        """
+        try:
+            return self.lookup(kernel_name, resource_dir)[1]
+        except (OSError, ValueError):
+            return False
+
+    def prune(self, kernel_names):
+        """Forget any kernels that are not in kernel_names."""
+        for kernel_name in list(self.kernels):
+            if kernel_name not in kernel_names:
+                del self.kernels[kernel_name]
+                self.dirty = True
+
 
 def delete_kernel(kernel_name):
     """
@@ -60,19 +201,17 @@ def show_kernel(kernel_name):
     """
     # Load the raw json, since we store some unexpected data in there too
     spec = ks.get_kernel_spec(kernel_name)
-    with open(path.join(spec.resource_dir, 'kernel.json')) as kernel_file:
-        kernel_json = json.load(kernel_file)
+    # Read in one go, each read may be a round trip on a network filesystem
+    kernel_json_path = path.join(spec.resource_dir, 'kernel.json')
+    with open(kernel_json_path, 'rb', buffering=65536) as kernel_file:
+        kernel_json = _loads(kernel_file.read())
 
     # Manually format the json to put each key: value on a single line
-    print("Kernel found in: {}".format(spec.resource_dir))
-    print("Name: {}".format(spec.display_name))
-    print("Kernel command: {}".format(list2cmdline(spec.argv)))
-    print(
-        "Create command: {}".format(
-            list2cmdline(kernel_json['ikernel_remote_argv'])
-        )
-    )
-    print("Raw json: {}".format(json.dumps(kernel_json, indent=2)))
+    print(f"Kernel found in: {spec.resource_dir}")
+    print(f"Name: {spec.display_name}")
+    print(f"Kernel command: {_cmdline(spec.argv)}")
+    print(f"Create command: {_cmdline(kernel_json['ikernel_remote_argv'])}")
+    print(f"Raw json: {json.dumps(kernel_json, indent=2)}")
 
 
 def add_kernel(
@@ -99,95 +238,86 @@ def add_kernel(
     """
     kernel_name = []
     display_name = []
-    argv = [sys.executable, '-m', 'ikernel_remote']
+    argv = [_PY_EXE, '-m', 'ikernel_remote']
 
     # How to connect to kernel
-    if interface == 'local':
-        argv.extend(['--interface', 'local'])
-        kernel_name.append('local')
-        display_name.append("Local")
-    elif interface == 'pbs':
-        argv.extend(['--interface', 'pbs'])
-        display_name.append('PBS')
-    elif interface == 'sge':
-        argv.extend(['--interface', 'sge'])
-        kernel_name.append('sge')
-        display_name.append("GridEngine")
-    elif interface == 'ssh':
+    if interface not in _INTERFACES:
+        raise ValueError(f"Unknown interface {interface}")
+    interface_name, interface_display = _INTERFACES[interface]
+    argv.extend(('--interface', interface))
+    if interface_name is not None:
+        kernel_name.append(interface_name)
+    display_name.append(interface_display)
+    if interface == 'ssh':
         if host is None:
             raise KeyError('A host is required for ssh.')
-        argv.extend(['--interface', 'ssh'])
-        argv.extend(['--host', host])
-        kernel_name.append('ssh')
+        argv.extend(('--host', host))
         kernel_name.append(host)
-        display_name.append("SSH")
         display_name.append(host)
-    elif interface == 'slurm':
-        argv.extend(['--interface', 'slurm'])
-        kernel_name.append('slurm')
-        display_name.append("SLURM")
-    else:
-        raise ValueError("Unknown interface {}".format(interface))
 
     display_name.append(name)
-    kernel_name.append(re.sub(r'\W', '', name).lower())
+    kernel_name.append(_NONWORD.sub('', name).lower())
 
     if pe is not None:
-        argv.extend(['--pe', pe])
+        argv.extend(('--pe', pe))
         kernel_name.append(pe)
         display_name.append(pe)
 
     if cpus and cpus > 1:
-        argv.extend(['--cpus', str(cpus)])
-        kernel_name.append('{}cpus'.format(cpus))
-        display_name.append('{} CPUs'.format(cpus))
+        argv.extend(('--cpus', str(cpus)))
+        kernel_name.append(f'{cpus}cpus')
+        display_name.append(f'{cpus} CPUs')
 
     if mem is not None:
-        argv.extend(['--mem', mem])
+        argv.extend(('--mem', mem))
         kernel_name.append(mem.lower())
         display_name.append(mem)
 
     if time is not None:
-        argv.extend(['--time', time])
-        kernel_name.append('t{}'.format(re.sub(r'\W', '', time).lower()))
+        argv.extend(('--time', time))
+        kernel_name.append(f"t{_NONWORD.sub('', time).lower()}")
         display_name.append(time)
 
-    if workdir is not None:
-        argv.extend(['--workdir', workdir])
-
-    if runtimedir is not None:
-        argv.extend(['--runtimedir', runtimedir])
-
-    if precmd is not None:
-        argv.extend(['--precmd', precmd])
-
-    if launch_args is not None:
-        argv.extend(['--launch-args', launch_args])
+    # Options that are passed straight on to the kernel launcher
+    for flag, value in (
+        ('--workdir', workdir),
+        ('--runtimedir', runtimedir),
+        ('--precmd', precmd),
+        ('--launch-args', launch_args),
+    ):
+        if value is not None:
+            argv.append(flag)
+            argv.append(value)
 
     if verbose:
-        argv.extend(['--verbose'])
+        argv.append('--verbose')
 
     # protect the {connection_file} part of the kernel command
     if kernel_cmd is not None:
         kernel_cmd = kernel_cmd.replace(
             '{connection_file}', '{host_connection_file}'
         )
-        argv.extend(['--kernel_cmd', kernel_cmd])
+        argv.extend(('--kernel_cmd', kernel_cmd))
 
     if tunnel_hosts:
         # This will be a list of hosts
-        kernel_name.append('via_{}'.format("_".join(tunnel_hosts)))
-        display_name.append("(via {})".format(" ".join(tunnel_hosts)))
+        kernel_name.append(f"via_{'_'.join(tunnel_hosts)}")
+        display_name.append(f"(via {' '.join(tunnel_hosts)})")
         argv.extend(['--tunnel-hosts'] + tunnel_hosts)
 
     # ikernel_remote needs the connection file too
-    argv.extend(['-f', '{connection_file}'])
+    argv.extend(('-f', '{connection_file}'))
 
     # Prefix all kernels with 'rik_' for management.
     kernel_name = 'remote_' + '_'.join(kernel_name)
     # Having an @ in the string messes up the javascript;
     # so get rid of evrything just in case.
-    kernel_name = re.sub(r'\W', '_', kernel_name)
+    kernel_name = _NONWORD.sub('_', kernel_name)
+    # Jupyter lowercases names on install, do the same so that kernels
+    # written directly end up in the same directory
+    kernel_name = kernel_name.lower()
+    if not _VALID_KERNEL_NAME.match(kernel_name):
+        raise ValueError(f"Invalid kernel name {kernel_name!r}")
     kernel_json = {
         'display_name': " ".join(display_name),
         'argv': argv,
@@ -200,26 +330,114 @@ def add_kernel(
     # the kernel
     kernel_json['ikernel_remote_argv'] = sys.argv
 
-    # False attempts a system install, otherwise install as the current user
+    # kernel.json file installation
     if system:
-        username = False
-    else:
-        username = getpass.getuser()
+        # The system location and permissions depend on the Jupyter
+        # version, so leave it to install_kernel_spec
+        with tempdir.TemporaryDirectory() as temp_dir:
+            os.chmod(temp_dir, 0o755)  # Starts off as 700, not user readable
 
-    # kernel.json file installation
-    with tempdir.TemporaryDirectory() as temp_dir:
-        os.chmod(temp_dir, 0o755)  # Starts off as 700, not user readable
+            kernel_json_path = path.join(temp_dir, 'kernel.json')
+            with open(kernel_json_path, 'wb') as kernel_file:
+                kernel_file.write(_dumps(kernel_json))
 
-        with open(path.join(temp_dir, 'kernel.json'), 'w') as kernel_file:
-            json.dump(kernel_json, kernel_file, sort_keys=True, indent=2)
+            ks.install_kernel_spec(
+                temp_dir, kernel_name, user=False, replace=True
+            )
+        return kernel_name
 
-        ks.install_kernel_spec(
-            temp_dir, kernel_name, user=username, replace=True
-        )
+    # Install as the current user by writing the kernel.json straight
+    # into place, rather than copying it from a temporary directory
+    kernel_dir = path.join(ks.KernelSpecManager().user_kernel_dir, kernel_name)
+    kernel_json_path = path.join(kernel_dir, 'kernel.json')
+
+    # Nothing to do if the same kernel is already installed
+    try:
+        with open(kernel_json_path, 'rb') as kernel_file:
+            if _loads(kernel_file.read()) == kernel_json:
+                return kernel_name
+    except (OSError, ValueError):
+        pass
+
+    os.makedirs(kernel_dir, exist_ok=True)
+    # Replace atomically so a half written file is never seen
+    with open(kernel_json_path + '.tmp', 'wb') as kernel_file:
+        kernel_file.write(_dumps(kernel_json))
+    os.replace(kernel_json_path + '.tmp', kernel_json_path)
 
     return kernel_name
 
 
+def _is_remote_kernel(kernel_name):
+    """
+    Look up a single kernel and check that it is managed by ikernel_remote,
+    without going through all the installed kernels.
+    """
+    try:
+        spec = ks.get_kernel_spec(kernel_name)
+    except KeyError:
+        # NoSuchKernel is a KeyError
+        return False
+    return 'ikernel_remote' in spec.argv
+
+
+def _find_kernel_dirs():
+    """
+    Find the directories of all the installed kernels, keyed on kernel
+    name. Like find_kernel_specs, but each search directory is read with
+    a single scandir and kernels in earlier directories take precedence.
+    """
+    kernel_dirs = {}
+    for base in ks.KernelSpecManager().kernel_dirs:
+        try:
+            entries = list(os.scandir(base))
+        except OSError:
+            # Search directories don't have to exist
+            continue
+        for entry in entries:
+            kernel_name = entry.name.lower()
+            if kernel_name in kernel_dirs or not entry.is_dir():
+                continue
+            # Only directories with a kernel.json are kernels, others
+            # must not hide a kernel of the same name further down
+            if path.isfile(path.join(entry.path, 'kernel.json')):
+                kernel_dirs[kernel_name] = entry.path
+    return kernel_dirs
+
+
+def _enumerate_remote_kernels():
+    """
+    Find the installed kernels that are managed by ikernel_remote.
+
+    Yields
+    ------
+    kernel_name, display_name : str, str
+        Each remote kernel, sorted by kernel name.
+    """
+    cache = _SpecCache()
+    cache.load()
+    specs = _find_kernel_dirs()
+    # Sort so they are always in the same order, only the remote
+    # kernels need sorting
+    for kernel_name in sorted(
+        name for name in specs if cache.is_remote(name, specs[name])
+    ):
+        yield kernel_name, cache.kernels[kernel_name]['display_name']
+    cache.prune(specs)
+    cache.save()
+
+
+def _print_kernels():
+    """
+    Print the list of installed remote kernels, writing each one as
+    soon as it is found.
+    """
+    write = sys.stdout.write
+    write("Currently installed remote kernels:\n")
+    for kernel_name, display_name in _enumerate_remote_kernels():
+        write(f"  {kernel_name} : {display_name}\n")
+
+
 def manage():
     """
     Manage the available ikernel_remotes.
@@ -227,21 +445,18 @@ def manage():
     All the options are pulled from arguments so we take no
     arguments here.
     """
+    # Only needed here, keep importing the module cheap
+    import argparse
 
-    kernels_display = [
-        "Currently installed remote kernels:"
-    ]
-    kernels = {}
+    # Skip 'manage' in the arguments
+    argv = sys.argv[1:]
+    if argv and argv[0] == 'manage':
+        argv = argv[1:]
 
-    # Sort so they are always in the same order
-    for kernel_name in sorted(ks.find_kernel_specs()):
-        spec = ks.get_kernel_spec(kernel_name)
-        if 'ikernel_remote' in spec.argv:
-            display = "  {name} : {desc}".format(
-                name=kernel_name, desc=spec.display_name
-            )
-            kernels[kernel_name] = spec
-            kernels_display.append(display)
+    # Listing the kernels is the most common use and doesn't need the parser
+    if not argv:
+        _print_kernels()
+        return
 
     # The raw formatter stops lines wrapping
     parser = argparse.ArgumentParser(
@@ -376,12 +591,7 @@ def manage():
         "kernel will produce verbose debugging on the console."
     )
 
-    # Temporarily remove 'manage' from the arguments
-    raw_args = sys.argv[:]
-    if len(sys.argv) > 1 and sys.argv[1] == 'manage':
-        del sys.argv[1]
-    args = parser.parse_args()
-    sys.argv = raw_args
+    args = parser.parse_args(argv)
 
     if args.add:
         kernel_name = add_kernel(
@@ -392,16 +602,16 @@ def manage():
         )
         print("Installed kernel {}.".format(kernel_name))
     elif args.delete:
-        if args.delete in kernels:
+        if _is_remote_kernel(args.delete):
             delete_kernel(args.delete)
         else:
-            print("Can't delete {}".format(args.delete))
-            print("\n" + "\n".join(kernels_display))
+            print("Can't delete {}\n".format(args.delete))
+            _print_kernels()
     elif args.show:
-        if args.show in kernels:
+        if _is_remote_kernel(args.show):
             show_kernel(args.show)
         else:
-            print("Kernel {} doesn't exist".format(args.show))
-            print("\n" + "\n".join(kernels_display))
+            print("Kernel {} doesn't exist\n".format(args.show))
+            _print_kernels()
     else:
-        print("\n".join(kernels_display))
+        _print_kernels()